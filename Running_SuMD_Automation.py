@@ -1,12 +1,14 @@
 import os
-import subprocess
+import asyncio
+import shutil
+from pathlib import Path
+from functools import lru_cache
 from tqdm import tqdm
+from pdbfixer import PDBFixer
+from openmm.app import PDBFile
 from os.path import join
 import json
 import re
-import select
-import sys
-import time
 
 debug_mode = True
 
@@ -19,58 +21,16 @@ configuration = {
     "pdb_list_path" : "/root/SMC_PPI_MD/Dataset/test_pdb_list",
     "pdb2amber_path" : "/root/SMC_PPI_MD/pdb2amber/",
     "box_size" : 35,   #35 angstrom
-    "ions_mdp_path" : "/root/SMC_PPI_MD/SuMD/ions.mdp"
+    "ions_mdp_path" : "/root/SMC_PPI_MD/SuMD/ions.mdp",
+    "n_workers" : 4    # 동시에 처리할 PDB 개수
 }
 
-def run_script(script, path):
-    try :
-        subprocess.run(script, cwd = path,  shell =True)
-    except Exception as e :
-        print(f"Running Failed : {e}  || {script} ||")
-
-class MD_automation():
-    def __init__(self, config ):
-        self.dataset_path = config["dataset_path"]
-        self.save_path = config["save_path"]
-        self.pdb_ID_list = []
-        with open(config["pdb_list_path"], 'r') as f:
-            for line in f:  # iterate over each line in the file
-                self.pdb_ID_list.append(line.strip()[:-4])  # .strip() removes any trailing newline characters
-        self.SuMD_path = config["SuMD_path"]
-        self.pdb2amber = config["pdb2amber_path"]
-        self.box_len = config["box_size"]
-        self.ions_mdp = config["ions_mdp_path"]
-        
-    def inputfile_generation(self, complex_name):
-        protein_resid =[]
-        ligand_resid = []
-        protein = ""
-        peptide = ""
-        protein_ID = complex_name[-1]
-        peptide_chain_ID = complex_name[-3]
+# GROMACS가 덮어쓰는 파일을 #file.1# 형태로 백업하지 않도록 설정
+_GMX_ENV = {**os.environ, "GMX_MAXBACKUP": "-1"}
 
-        with open(f"{self.dataset_path}{complex_name}.pdb", 'r') as complex:
-            for line in complex.readlines():
-                line = str(line).split()
-                if line[4] == protein_ID:
-                    protein_resid.append(line[5])
-                elif line[4] == peptide_chain_ID:
-                    ligand_resid.append(line[5])
-
-        protein_resid = list(set(protein_resid))
-        ligand_resid = list(set(ligand_resid))
-
-        for resid in protein_resid:
-            protein += f"{resid} "
-        protein = protein[:-1]
-        
-        for resid in ligand_resid:
-            peptide += f"{resid} "
-        peptide = peptide[:-1]
-
-        script = f"""### SYSTEM SETTING
-structre={complex_name}_sumd.pdb
-parameters={complex_name}_sumd.prmtop
+_DAT_TEMPLATE = """### SYSTEM SETTING
+structre={name}_sumd.pdb
+parameters={name}_sumd.prmtop
 ForceField=AMBER
 
 #RECEPTOR
@@ -96,111 +56,164 @@ bound_dist=10
 meta_dist=15
 """
 
+# step, 박스 벡터 a/b/c, origin
+_XSC_TEMPLATE = "1000000 {box:e} 0.000000e+00 0.000000e+00 0.000000e+00 {box:e} 0.000000e+00 0.000000e+00 0.000000e+00 {box:e} 0.000000e+00 0.000000e+00 0.000000e+00"
+
+_SOL_RE = re.compile(r"^\s*(\d+)\s+SOL\s+:", re.MULTILINE)
+_WATER_RE = re.compile(r"^\s*(\d+)\s+Water\s+:", re.MULTILINE)
+
+async def run_script(argv, path, input_str=None, capture=False, log_file=None):
+    # 출력이 필요 없는 호출은 stdout을 DEVNULL로 버리고, gmx 배너도 -quiet로 끔
+    # log_file을 주면 (suMD처럼 오래 걸리는 명령) 출력을 pipe 없이 파일로 바로 기록
+    # 종료 코드가 0이 아니면 stderr(또는 출력)의 마지막 부분과 함께 RuntimeError를 발생시킴
+    if argv[0] == "gmx":
+        argv = argv + ["-quiet"]
+    log = open(log_file, 'wb') if log_file is not None else None
+    try :
+        if log is not None:
+            stdout, stderr = log, asyncio.subprocess.STDOUT
+        elif capture:
+            stdout, stderr = asyncio.subprocess.PIPE, asyncio.subprocess.STDOUT
+        else:
+            stdout, stderr = asyncio.subprocess.DEVNULL, asyncio.subprocess.PIPE
+        proc = await asyncio.create_subprocess_exec(
+            *argv,
+            cwd = path,
+            stdin = asyncio.subprocess.PIPE if input_str is not None else None,
+            stdout = stdout,
+            stderr = stderr,
+            env = _GMX_ENV
+        )
+        output, errors = await proc.communicate(input_str.encode() if input_str is not None else None)
+    finally:
+        if log is not None:
+            log.close()
+
+    if proc.returncode != 0:
+        if log is not None:
+            detail = f"see {log_file}"
+        else:
+            detail = (errors or output or b"")[-2000:].decode(errors="replace")
+        raise RuntimeError(f"Running Failed (exit {proc.returncode}) || {' '.join(argv)} ||\n{detail}")
+    return output.decode(errors="replace") if capture and log is None else ""
+
+def _cp(src, dst, link=True):
+    # link=True이면 같은 파일시스템에서 hardlink, 아니면 복사. 기존 dst는 덮어씀 (재실행 시 이전 시도의 파일)
+    # gmx 등이 나중에 그 자리에서 다시 쓰는 파일은 link=False로 복사해서 원본과 inode를 공유하지 않음
+    if os.path.isdir(dst):
+        dst = join(dst, os.path.basename(src))
+    if link:
+        Path(dst).unlink(missing_ok=True)
+        try :
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    # 임시 파일에 복사한 뒤 rename해서 기존 dst의 inode는 건드리지 않음
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+@lru_cache(maxsize=4096)
+def _chain_residues(pdb_file, mtime):
+    # chain ID -> residue 번호 집합. mtime을 key에 포함해서 파일이 바뀌면 다시 읽음
+    # PDB 고정 컬럼: chain ID = 22번째, resSeq = 23-26번째
+    residues = {}
+    with open(pdb_file, 'r') as f:
+        for line in f:
+            if not line.startswith(("ATOM", "HETATM")):
+                continue
+            residues.setdefault(line[21], set()).add(line[22:26].strip())
+    return {chain_ID: frozenset(resids) for chain_ID, resids in residues.items()}
+
+def fix_pdb(input_pdb, output_pdb):
+    # `pdbfixer input --replace-nonstandard --add-atoms=all --output=output` 와 동일한 처리를
+    # 같은 프로세스 안에서 수행 (PDB마다 Python + OpenMM을 새로 띄우지 않음)
+    fixer = PDBFixer(filename=input_pdb)
+    fixer.missingResidues = {}
+    fixer.findNonstandardResidues()
+    fixer.replaceNonstandardResidues()
+    fixer.findMissingAtoms()
+    fixer.addMissingAtoms()
+    fixer.addMissingHydrogens(7.0)
+    with open(output_pdb, 'w') as f:
+        PDBFile.writeFile(fixer.topology, fixer.positions, f)
+
+def _cleanup(path, patterns):
+    # glob 패턴별로 파일 삭제. 일치하는 파일이 없어도 다음 패턴은 계속 처리
+    for pattern in patterns:
+        for p in Path(path).glob(pattern):
+            p.unlink(missing_ok=True)
+
+class MD_automation():
+    def __init__(self, config ):
+        self.dataset_path = config["dataset_path"]
+        self.save_path = config["save_path"]
+        self.pdb_ID_list = [line.strip().removesuffix(".pdb") for line in Path(config["pdb_list_path"]).read_text().splitlines() if line.strip()]
+        self.SuMD_path = config["SuMD_path"]
+        self.pdb2amber = config["pdb2amber_path"]
+        self.box_len = config["box_size"]
+        self.xsc = _XSC_TEMPLATE.format(box=float(self.box_len))
+        self.ions_mdp = config["ions_mdp_path"]
+        self.n_workers = config["n_workers"]
+        
+    def inputfile_generation(self, complex_name):
+        protein_ID = complex_name[-1]
+        peptide_chain_ID = complex_name[-3]
+
+        pdb_file = f"{self.dataset_path}{complex_name}.pdb"
+        chain_residues = _chain_residues(pdb_file, os.path.getmtime(pdb_file))
+        protein_resid = chain_residues.get(protein_ID, frozenset())
+        ligand_resid = chain_residues.get(peptide_chain_ID, frozenset())
+
+        protein = " ".join(sorted(protein_resid, key=int))
+        peptide = " ".join(sorted(ligand_resid, key=int))
+
         with open(f"{self.save_path}{complex_name}/{complex_name}.dat", 'w') as f:
-            f.write(script)
+            f.write(_DAT_TEMPLATE.format(name=complex_name, protein=protein, peptide=peptide))
 
         with open(f"{self.save_path}{complex_name}/{complex_name}_sumd.xsc", 'w') as f:
-            f.write(f"1000000 3.500000e+01 0.000000e+00 0.000000e+00 0.000000e+00 3.500000e+01 0.000000e+00 0.000000e+00 0.000000e+00 3.500000e+01 0.000000e+00 0.000000e+00 0.000000e+00")
+            f.write(self.xsc)
 
-    def generate_prmtop(self, complex_name):
+    async def generate_prmtop(self, complex_name):
         pdb_path = self.save_path + complex_name + "/"
         box_len = self.box_len
 
         with open(f"{pdb_path}{complex_name}.pdb", 'r') as infile, open(f"{pdb_path}H_fixed_{complex_name}.pdb", 'w') as outfile:   ## HETATM chain 어떻게 처리할지 
-            for line in infile:
-                if not line.startswith("HETATM"):
-                    outfile.write(line)
+            outfile.writelines(line for line in infile if line[:6] != "HETATM")
 
-        subprocess.run(f"cp {self.SuMD_path}ions.mdp {pdb_path}", cwd = self.SuMD_path, shell=True)
-        subprocess.run(f"pdbfixer H_fixed_{complex_name}.pdb --replace-nonstandard --add-atoms=all --output=fixed_{complex_name}.pdb", cwd = pdb_path, shell=True)
+        _cp(f"{self.SuMD_path}ions.mdp", pdb_path)
+        await asyncio.to_thread(fix_pdb, f"{pdb_path}H_fixed_{complex_name}.pdb", f"{pdb_path}fixed_{complex_name}.pdb")
 
         #editconf
-        script = f"gmx editconf -f fixed_{complex_name}.pdb -o processed_{complex_name}.pdb -box {box_len} {box_len} {box_len}" 
-        run_script(script=script, path = pdb_path)
-        time.sleep(0.5)
-        script = f"gmx pdb2gmx -f processed_{complex_name}.pdb -o processed_{complex_name}.gro -water tip3p -ignh"
-        subprocess.run(script, input="1\n", cwd= pdb_path , text=True, shell =True)
-        time.sleep(0.5)
+        argv = ["gmx", "editconf", "-f", f"fixed_{complex_name}.pdb", "-o", f"processed_{complex_name}.pdb", "-box", str(box_len), str(box_len), str(box_len)]
+        await run_script(argv, path = pdb_path)
+        argv = ["gmx", "pdb2gmx", "-f", f"processed_{complex_name}.pdb", "-o", f"processed_{complex_name}.gro", "-water", "tip3p", "-ignh"]
+        await run_script(argv, path = pdb_path, input_str="1\n")
         #solvate
-        script = f"gmx solvate -cp processed_{complex_name}.gro -cs spc216.gro -o {complex_name}_solvate.gro -p topol.top"
-        run_script(script=script, path = pdb_path)
+        argv = ["gmx", "solvate", "-cp", f"processed_{complex_name}.gro", "-cs", "spc216.gro", "-o", f"{complex_name}_solvate.gro", "-p", "topol.top"]
+        await run_script(argv, path = pdb_path)
 
-        script = f"gmx grompp -f ions.mdp -c {complex_name}_solvate.gro -p topol.top -o ions.tpr"
-        run_script(script=script, path = pdb_path)
+        argv = ["gmx", "grompp", "-f", "ions.mdp", "-c", f"{complex_name}_solvate.gro", "-p", "topol.top", "-o", "ions.tpr"]
+        await run_script(argv, path = pdb_path)
 
         #ionize
-        master_fd, slave_fd = os.openpty()
-        script = f"gmx genion -s {pdb_path}ions.tpr -o {pdb_path}{complex_name}_ionized.pdb -p {pdb_path}topol.top -pname NA -nname CL -conc 0.15"
-
-        proc = subprocess.Popen(
-            script,
-            stdin=slave_fd,
-            stdout=slave_fd,
-            stderr=slave_fd,
-            text=True,
-            bufsize=0,
-            shell = True
-        )
-        os.close(slave_fd)
-
-        sol_group = None
-        buffer = ""
-        prompt_sent = False
-
-        while True:
-            # master_fd에서 1초 동안 데이터가 도착하는지 확인
-            r, _, _ = select.select([master_fd], [], [], 4.0)
-            if master_fd in r:
-                try:
-                    data = os.read(master_fd, 1024).decode()
-                except OSError:
-                    break
-                if not data:
-                    break
-                # 받은 데이터를 즉시 출력
-                sys.stdout.write(data)
-                sys.stdout.flush()
-                buffer += data
-
-                # 버퍼를 줄 단위로 나눔
-                lines = buffer.splitlines(keepends=True)
-                for line in lines:
-                    # "SOL"이 포함된 줄에서 그룹 번호 추출 (최초 한 번만)
-                    if "SOL" in line and sol_group is None:
-                        match = re.search(r"Group\s+(\d+)\s+\(.*SOL.*\)", line)
-                        if match:
-                            sol_group = match.group(1)
-                        else :
-                            match_2 = re.search(r"Group\s+(\d+)\s+\(.*Water.*\)", line)
-                            if match_2:
-                                sol_group = match_2.group(1)
-                    # "Select a group:" 프롬프트가 나오면 입력 전송
-                    if "Select a group:" in line and not prompt_sent:
-                        if sol_group is None:
-                            # SOL 그룹 번호를 찾지 못했다면 빈 문자열을 입력하거나 원하는 기본값 사용
-                            sol_group = ""
-                        os.write(master_fd, (sol_group + "\n").encode())
-                        prompt_sent = True
-                        # 프롬프트 이후 버퍼는 초기화 (또는 필요에 따라 유지)
-                        buffer = ""
-            else:
-                # 지정한 시간 동안 더 이상 출력이 없으면 루프 종료
-                break
-
-        # 프로세스 종료 대기
-        proc.wait()
-        os.close(master_fd)
-
-        script = "rm '#topol.top.1#'; rm '#topol.top.2#' ; rm *.gro ; rm *.itp ; rm *.tpr; rm *.top; rm mdout.mdp; rm fixed_*.pdb; rm processed_*.pdb; rm H_fixed_*.pdb"
-        
+        # make_ndx의 기본 그룹 목록에서 SOL(없으면 Water) 그룹 번호를 미리 찾아 genion에 stdin으로 전달
+        argv = ["gmx", "make_ndx", "-f", "ions.tpr", "-o", "index.ndx"]
+        output = await run_script(argv, path = pdb_path, input_str="q\n", capture=True)
+        match = _SOL_RE.search(output) or _WATER_RE.search(output)
+        # 그룹 번호를 찾지 못하면 그룹 이름으로 선택
+        sol_group = match.group(1) if match else "SOL"
+
+        argv = ["gmx", "genion", "-s", "ions.tpr", "-n", "index.ndx", "-o", f"{complex_name}_ionized.pdb", "-p", "topol.top", "-pname", "NA", "-nname", "CL", "-conc", "0.15"]
+        await run_script(argv, path = pdb_path, input_str=f"{sol_group}\n")
+
         if not debug_mode:
-            subprocess.run(script, cwd = pdb_path, shell = True)
+            _cleanup(pdb_path, ["*.gro", "*.itp", "*.tpr", "*.top", "mdout.mdp", "index.ndx", "fixed_*.pdb", "processed_*.pdb", "H_fixed_*.pdb"])
 
-        script = f"cp {complex_name}_ionized.pdb {self.pdb2amber}"
-        subprocess.run(script, cwd = pdb_path, shell = True)
+        _cp(f"{pdb_path}{complex_name}_ionized.pdb", self.pdb2amber, link=False)
 
-        script = f"pdbfixer {complex_name}_ionized.pdb --replace-nonstandard --add-atoms=all --output={complex_name}_sumd.pdb"
-        run_script(script=script, path = self.pdb2amber)
+        await asyncio.to_thread(fix_pdb, f"{self.pdb2amber}{complex_name}_ionized.pdb", f"{self.pdb2amber}{complex_name}_sumd.pdb")
 
         #inputfile 
         data = {
@@ -215,38 +228,57 @@ meta_dist=15
         with open(f"{self.pdb2amber}{complex_name}_input.json", 'w') as f:
             json.dump(data, f)
 
-        script = f"python pdb2amber.py -i {complex_name}_input.json"
-        run_script(script=script, path = self.pdb2amber)
-
-        time.sleep(0.5)
+        argv = ["python", "pdb2amber.py", "-i", f"{complex_name}_input.json"]
+        await run_script(argv, path = self.pdb2amber)
 
         if not debug_mode:
-            script = f"rm {complex_name}_final.pdb; rm {complex_name}_input.json; cd {complex_name}_sumd.prmtop {pdb_path}"
-        else : 
-            script = f"cd {complex_name}_sumd.prmtop {pdb_path}"
-        run_script(script=script, path = self.pdb2amber)
+            _cleanup(self.pdb2amber, [f"{complex_name}_final.pdb", f"{complex_name}_input.json"])
+        _cp(f"{self.pdb2amber}{complex_name}_sumd.prmtop", pdb_path, link=False)
 
-    def MD_run(self, inputfile, pdb_ID):
-        subprocess.run(f"python3 {self.SuMD_path}suMD {inputfile}", cwd = f"{self.save_path}{pdb_ID}", shell=True)
+    async def MD_run(self, inputfile, pdb_ID):
+        await run_script(["python3", f"{self.SuMD_path}suMD", inputfile], path = f"{self.save_path}{pdb_ID}",
+                         log_file = f"{self.save_path}{pdb_ID}/{pdb_ID}_sumd.log")
         if not debug_mode:
-            subprocess.run(f'rm {pdb_ID}.pdb ; rm {pdb_ID}.dat', cwd = f"{self.save_path}{pdb_ID}", shell = True)
+            _cleanup(f"{self.save_path}{pdb_ID}", [f"{pdb_ID}.pdb", f"{pdb_ID}.dat"])
+
+    async def process_one(self, pdb_ID, sem):
+        async with sem:
+            os.makedirs(f"{self.save_path}{pdb_ID}", exist_ok=True)
+            # 성공적으로 끝난 PDB에만 .done 파일을 남기므로, 없으면 (재)실행
+            done = Path(f"{self.save_path}{pdb_ID}/.done")
+            if done.exists():
+                return
 
-    def MD_automation_start(self):
-        for pdb_ID in tqdm(self.pdb_ID_list):
-            if os.path.exists(f"{self.save_path}{pdb_ID}"):
-                continue
-            else :
-                os.mkdir(f"{self.save_path}{pdb_ID}")
-                
-            subprocess.run(f"cp {pdb_ID}.pdb {self.save_path}{pdb_ID}/", cwd = self.dataset_path, shell = True)   
             try :
-                self.generate_prmtop(pdb_ID)     
+                # 입력 PDB가 없거나 복사에 실패해도 이 PDB만 error.txt를 남기고 다음으로 넘어감
+                _cp(f"{self.dataset_path}{pdb_ID}.pdb", f"{self.save_path}{pdb_ID}/")
+                await self.generate_prmtop(pdb_ID)
+                # 중간 단계가 에러 없이 끝났어도 prmtop이 없으면 SuMD를 돌리지 않음
+                prmtop = Path(f"{self.save_path}{pdb_ID}/{pdb_ID}_sumd.prmtop")
+                if not prmtop.exists():
+                    raise RuntimeError(f"{prmtop} was not generated")
                 self.inputfile_generation(pdb_ID)
-                self.MD_run(f"{self.save_path}{pdb_ID}.dat", pdb_ID)
+                # run_script는 suMD가 0이 아닌 코드로 끝나면 예외를 발생시키므로 여기까지 오면 성공
+                await self.MD_run(f"{self.save_path}{pdb_ID}/{pdb_ID}.dat", pdb_ID)
+                Path(f"{self.save_path}{pdb_ID}/error.txt").unlink(missing_ok=True)
+                done.touch()
             except Exception as e :
                 with open(f"{self.save_path}{pdb_ID}/error.txt", 'w') as f:
                     f.write(f"Error : {e}")
-                continue
+
+    async def run_all(self):
+        # PDB마다 작업 디렉토리가 독립적이므로 n_workers 개까지 동시에 실행
+        sem = asyncio.Semaphore(self.n_workers)
+        tasks = [self.process_one(pdb_ID, sem) for pdb_ID in self.pdb_ID_list]
+        # PDB 하나에서 예외가 나도 나머지 PDB 작업이 취소되지 않도록 여기서 잡음
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            try :
+                await task
+            except Exception as e :
+                print(f"Processing Failed : {e}")
+
+    def MD_automation_start(self):
+        asyncio.run(self.run_all())
 
 if __name__ == '__main__':
     MD = MD_automation(configuration)
@@ -1,22 +1,98 @@
 import subprocess
 import argparse
 import os
+import glob
+import shutil
+import hashlib
+import sys
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-def run_command(cmd, input_str=None):
+# GROMACS가 덮어쓰는 파일을 #file.1# 형태로 백업하지 않도록 설정
+# GPU가 여러 개일 때 GPU 간 직접 통신 사용
+GMX_ENV = {**os.environ, "GMX_MAXBACKUP": "-1", "GMX_ENABLE_DIRECT_GPU_COMM": "1"}
+
+FORCE_FIELD = "charmm27"
+WATER_MODEL = "tip3p"
+# 같은 입력으로 이미 만든 solvated system을 보관하는 디렉토리 이름 (--output_dir 아래에 생성)
+SYSTEM_CACHE_DIR = ".sumd_cache"
+# 입력 내용의 sha256으로 찾는 grompp 결과(tpr) 보관 디렉토리 (system cache 아래)
+TPR_CACHE_DIR = os.path.join(SYSTEM_CACHE_DIR, "tpr")
+
+def run_command(cmd, input_str=None, cwd=None, log_file=None):
+    # gmx 배너는 -quiet로 끄고 stdout은 버림. stderr는 실패했을 때만 출력
+    # cwd를 명시해서 os.chdir 없이 작업 디렉토리별로 실행 (여러 replica를 동시에 실행 가능)
+    # log_file을 주면 (mdrun처럼 오래 걸리는 명령) stdout/stderr를 메모리에 모으지 않고 파일로 바로 기록
+    if cmd[0] == "gmx":
+        cmd = cmd + ["-quiet"]
     print(f"Running command: {' '.join(cmd)}")
-    subprocess.run(cmd, input=input_str.encode() if input_str else None, check=True)
+    input_bytes = input_str.encode() if input_str else None
+    if log_file is not None:
+        with open(log_file, "wb") as log:
+            try:
+                subprocess.run(cmd, input=input_bytes, check=True, env=GMX_ENV, cwd=cwd,
+                               stdout=log, stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError:
+                print(f"Command failed, see {log_file}")
+                raise
+        return
+    try:
+        subprocess.run(cmd, input=input_bytes, check=True, env=GMX_ENV, cwd=cwd,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        print(e.stderr.decode(errors="replace"))
+        raise
 
-def create_short_mdp(filename="short.mdp"):
-    if not os.path.exists(filename):
-        mdp_content = """
+def detect_gpus():
+    # nvidia-smi -L 출력의 "GPU 0: ..." 줄 수로 CUDA GPU 개수 확인 (드라이버가 없으면 0)
+    try:
+        result = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 0
+    return sum(1 for line in result.stdout.splitlines() if line.startswith("GPU "))
+
+def mdrun_command(deffnm, nthreads, pin_offset=0, mdrun_options=None, em=False):
+    # thread 수와 core pinning을 명시해서 자동 설정이 core를 놀리거나 oversubscribe하지 않도록 함
+    options = mdrun_options or {}
+    # nthreads는 이 mdrun에 나눠준 core 수 (pin_offset부터). --ntomp를 줘도 그 범위를 넘지 않도록 제한해서
+    # 동시에 실행하는 branch/replica끼리 pinning 범위가 겹치지 않도록 함
+    ntmpi = options.get("ntmpi") or 1
+    slice_ntomp = max(1, nthreads // ntmpi)
+    ntomp = min(options.get("ntomp") or slice_ntomp, slice_ntomp)
+    cmd = ["gmx", "mdrun", "-deffnm", deffnm,
+           "-ntmpi", str(ntmpi), "-ntomp", str(ntomp),
+           "-pin", "on", "-pinstride", "1", "-pinoffset", str(pin_offset)]
+    # GPU offload 설정. 에너지 최소화(steep)는 -update gpu, -pme gpu (동역학 integrator 전용)를 지원하지 않으므로 제외
+    for key in ("nb", "pme", "bonded") + (() if em else ("update",)):
+        if not options.get(key) or (em and key == "pme" and options[key] == "gpu"):
+            continue
+        cmd += [f"-{key}", options[key]]
+    # rank가 여러 개일 때 PME를 GPU에서 계산하려면 PME 전용 rank를 하나로 지정해야 함
+    if not em and options.get("pme") == "gpu" and ntmpi > 1:
+        cmd += ["-npme", "1"]
+    if options.get("gpu_id"):
+        cmd += ["-gpu_id", options["gpu_id"]]
+    return cmd
+
+SHORT_MDP_TEMPLATE = """
 integrator  = md
 nsteps      = 2500      ; 5 ps with 2 fs timestep
 dt          = 0.002
-nstxout     = 500
-nstvout     = 500
-nstenergy   = 500
-nstlog      = 500
+; SuMD는 segment 마지막 frame의 거리만 사용하므로 압축 좌표(xtc) 마지막 frame만 기록
+nstxout     = 0
+nstvout     = 0
+nstfout     = 0
+nstxout-compressed     = 2500
+compressed-x-precision = 1000
+nstenergy   = 2500
+nstlog      = 2500
+cutoff-scheme = Verlet
+nstlist     = 20
 continuation    = no
+; branch마다 새 초기 속도를 생성 (gen_seed = -1이면 grompp가 임의로 선택)
+gen_vel     = yes
+gen_temp    = 300
+gen_seed    = {gen_seed}
 constraint_algorithm = lincs
 constraints = all-bonds
 lincs_iter  = 1
@@ -37,111 +113,358 @@ pbc         = xyz
 ; Dispersion correction
 DispCorr    = EnerPres
 """
-        with open(filename, "w") as f:
-            f.write(mdp_content)
-        print(f"Created default {filename}")
 
-def create_emin_mdp(filename="emin.mdp"):
-    if not os.path.exists(filename):
-        mdp_content = """
+EMIN_MDP = """
 integrator  = steep
 nsteps      = 5000
 emtol       = 1000.0
 energygrps  = System
 """
+
+def create_short_mdp(filename="short.mdp", gen_seed=-1):
+    if not os.path.exists(filename):
         with open(filename, "w") as f:
-            f.write(mdp_content)
+            f.write(SHORT_MDP_TEMPLATE.format(gen_seed=gen_seed))
         print(f"Created default {filename}")
 
-def prepare_system(pdb_file, peptide_res_list, protein_res_list):
-    # (1) pdb2gmx: AMBER14SB force field와 TIP3P water 모델 사용
-    run_command(["gmx", "pdb2gmx", "-f", pdb_file, "-o", "processed.gro", "-p", "topol.top", "-ff", "charmm27", "-water", "tip3p", "-ignh"])
-    
-    # (2) editconf: 시뮬레이션 박스 생성 (중심 배치, 1.0 nm 여유, cubic)
-    run_command(["gmx", "editconf", "-f", "processed.gro", "-o", "newbox.gro", "-c", "-d", "1.0", "-bt", "cubic"])
-
-    # (3) solvate: 물 추가
-    run_command(["gmx", "solvate", "-cp", "newbox.gro", "-cs", "spc216.gro", "-o", "solvated.gro", "-p", "topol.top"])
-
-    # (4) make_ndx: peptide와 protein의 결합하는 residue 선택 → union 그룹 생성
-    # 주의: "r 45" 등으로 선택하면 생성된 그룹 이름은 보통 "45"가 됩니다.
-    index_commands_lines = []
-    for res in peptide_res_list:
-        index_commands_lines.append(f"r {res}")
-    # union: peptide_grp = 45 | 46 | 47 (입력 번호에 따라)
-    index_commands_lines.append("peptide_grp = " + " | ".join(f"{res}" for res in peptide_res_list))
-    
-    for res in protein_res_list:
-        index_commands_lines.append(f"r {res}")
-    index_commands_lines.append("protein_grp = " + " | ".join(f"{res}" for res in protein_res_list))
-    
-    index_commands_lines.append("q")
-    index_commands = "\n".join(index_commands_lines) + "\n"
-    
-    run_command(["gmx", "make_ndx", "-f", "solvated.gro", "-o", "index.ndx"], input_str=index_commands)
+def create_emin_mdp(filename="emin.mdp"):
+    if not os.path.exists(filename):
+        with open(filename, "w") as f:
+            f.write(EMIN_MDP)
+        print(f"Created default {filename}")
 
-def run_energy_minimization(iteration, start_coord):
+def last_frame_time(mdp_file):
+    # mdp의 tinit/dt/nsteps/nstxout-compressed로 xtc에 기록되는 마지막 frame의 시각(ps)을 계산
+    # (사용자가 만든 short.mdp를 그대로 쓰는 경우에도 실제 segment 길이를 따름)
+    # 계산할 수 없으면 (nsteps = -1, xtc 미기록) None
+    params = {}
+    with open(mdp_file, "r") as f:
+        for line in f:
+            line = line.split(";", 1)[0]
+            if "=" in line:
+                key, value = line.split("=", 1)
+                params[key.strip().lower().replace("_", "-")] = value.strip()
+    nsteps = int(params.get("nsteps", 0))
+    dt = float(params.get("dt", 0.001))
+    tinit = float(params.get("tinit", 0))
+    nstxout_compressed = int(params.get("nstxout-compressed", params.get("nstxtcout", 0)))
+    if nsteps < 0 or nstxout_compressed <= 0:
+        return None
+    # 반올림 오차로 마지막 frame이 빠지지 않도록 dt 절반만큼 여유를 둠
+    return tinit + (nsteps // nstxout_compressed) * nstxout_compressed * dt - 0.5 * dt
+
+def link_or_copy(src, dst):
+    # 같은 파일시스템이면 hardlink, 아니면 복사 (기존 dst는 덮어씀)
+    # main에서 만든 short.mdp / emin.mdp를 rep<i> 디렉토리로 가져올 때만 사용 (읽기 전용 파일)
+    # cache는 inode를 공유하지 않도록 copy_replace로만 주고받음
+    try:
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def copy_replace(src, dst):
+    # 임시 파일에 복사한 뒤 rename. dst와 inode를 공유하는 다른 파일(cache 등)은 건드리지 않음
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+def prepare_system(pdb_file, peptide_res_list, protein_res_list, cwd=".", cache_root=SYSTEM_CACHE_DIR):
+    # PDB 내용 + force field + water model이 같으면 이전에 만든 topology/solvated 구조를 재사용
+    # gmx가 작업 디렉토리의 파일을 그 자리에서 다시 쓰므로, cache와는 link가 아니라 복사로 주고받음
+    pdb_file = os.path.abspath(pdb_file)
+    with open(pdb_file, "rb") as f:
+        fingerprint = hashlib.sha1(f.read() + FORCE_FIELD.encode() + WATER_MODEL.encode()).hexdigest()
+    cache_dir = os.path.join(cache_root, fingerprint)
+
+    if os.path.exists(os.path.join(cache_dir, "solvated.gro")):
+        print(f"Reusing cached system from {cache_dir}")
+        for name in os.listdir(cache_dir):
+            copy_replace(os.path.join(cache_dir, name), os.path.join(cwd, name))
+    else:
+        # (1) pdb2gmx: topology 생성
+        run_command(["gmx", "pdb2gmx", "-f", pdb_file, "-o", "processed.gro", "-p", "topol.top", "-ff", FORCE_FIELD, "-water", WATER_MODEL, "-ignh"], cwd=cwd)
+        
+        # (2) editconf: 시뮬레이션 박스 생성 (중심 배치, 1.0 nm 여유, cubic)
+        run_command(["gmx", "editconf", "-f", "processed.gro", "-o", "newbox.gro", "-c", "-d", "1.0", "-bt", "cubic"], cwd=cwd)
+
+        # (3) solvate: 물 추가
+        run_command(["gmx", "solvate", "-cp", "newbox.gro", "-cs", "spc216.gro", "-o", "solvated.gro", "-p", "topol.top"], cwd=cwd)
+
+        # cache 저장: 임시 디렉토리에 모두 복사한 뒤 rename 한 번으로 공개해서
+        # 동시에 실행 중인 다른 replica가 만들다 만 cache를 읽지 않도록 함
+        # (다른 replica가 먼저 공개했으면 rename이 실패하므로 임시 디렉토리는 버림)
+        tmp_dir = f"{cache_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        itp_files = [os.path.basename(path) for path in glob.glob(os.path.join(cwd, "*.itp"))]
+        for name in ["topol.top"] + itp_files + ["solvated.gro"]:
+            shutil.copy2(os.path.join(cwd, name), os.path.join(tmp_dir, name))
+        try:
+            os.rename(tmp_dir, cache_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # (4) index 파일: peptide와 protein의 결합하는 residue로 그룹 생성
+    write_index_file(os.path.join(cwd, "solvated.gro"), peptide_res_list, protein_res_list, os.path.join(cwd, "index.ndx"))
+
+def write_index_file(gro_file, peptide_res_list, protein_res_list, index_file="index.ndx"):
+    # gmx make_ndx를 실행하는 대신 gro 파일의 residue 번호(make_ndx의 "r")로 atom 번호를 모아 직접 작성
+    # 그룹: System, Peptide_group, Protein_group
+    peptide_res = set(peptide_res_list)
+    protein_res = set(protein_res_list)
+    peptide_atoms = []
+    protein_atoms = []
+    with open(gro_file, "r") as f:
+        f.readline()  # title
+        n_atoms = int(f.readline())
+        for atom_idx in range(1, n_atoms + 1):
+            resnr = int(f.readline()[0:5])
+            if resnr in peptide_res:
+                peptide_atoms.append(atom_idx)
+            if resnr in protein_res:
+                protein_atoms.append(atom_idx)
+
+    groups = [("System", range(1, n_atoms + 1)),
+              ("Peptide_group", peptide_atoms),
+              ("Protein_group", protein_atoms)]
+    with open(index_file, "w") as f:
+        for name, atoms in groups:
+            f.write(f"[ {name} ]\n")
+            # gmx와 같이 한 줄에 15개씩 기록
+            for i in range(0, len(atoms), 15):
+                f.write(" ".join(f"{atom:4d}" for atom in atoms[i:i + 15]) + "\n")
+
+def grompp_cached(mdp_file, start_coord, tpr_file, cwd=".", cache_dir=TPR_CACHE_DIR):
+    # mdp + 시작 구조 + topology(itp 포함) + index 내용이 같으면 이전에 만든 tpr을 재사용
+    # (같은 PDB로 여러 replica를 돌릴 때 첫 에너지 최소화 tpr이 모두 동일함)
+    # 초기 속도를 임의로 생성하는 MD segment에는 사용하지 않음
+    inputs = [mdp_file, start_coord, "topol.top", "index.ndx"] + sorted(
+        os.path.basename(path) for path in glob.glob(os.path.join(cwd, "*.itp")))
+    digest = hashlib.sha256()
+    for name in inputs:
+        with open(os.path.join(cwd, name), "rb") as f:
+            digest.update(f.read())
+    cached_tpr = os.path.join(cache_dir, f"{digest.hexdigest()}.tpr")
+    tpr_path = os.path.join(cwd, tpr_file)
+
+    # cache와 inode를 공유하지 않도록 link 대신 복사
+    if os.path.exists(cached_tpr):
+        print(f"Reusing cached {cached_tpr}")
+        copy_replace(cached_tpr, tpr_path)
+        return
+    # 예전에 link로 가져온 tpr일 수 있으므로 grompp가 그 자리에 덮어쓰기 전에 지움
+    if os.path.lexists(tpr_path):
+        os.remove(tpr_path)
+    run_command(["gmx", "grompp", "-f", mdp_file, "-c", start_coord, "-p", "topol.top", "-n", "index.ndx", "-o", tpr_file], cwd=cwd)
+    # 다른 replica가 쓰는 중인 파일을 읽지 않도록 임시 파일에 복사한 뒤 rename
+    os.makedirs(cache_dir, exist_ok=True)
+    copy_replace(tpr_path, cached_tpr)
+
+def prepare_energy_minimization(iteration, start_coord, cwd=".", cache_dir=TPR_CACHE_DIR):
     emin_prefix = f"emin_{iteration}"
     # emin.mdp를 이용하여 에너지 최소화 시뮬레이션 준비
-    run_command(["gmx", "grompp", "-f", "emin.mdp", "-c", start_coord, "-p", "topol.top", "-n", "index.ndx", "-o", f"{emin_prefix}.tpr"])
+    grompp_cached("emin.mdp", start_coord, f"{emin_prefix}.tpr", cwd, cache_dir)
+    return f"{emin_prefix}.tpr"
+
+def run_energy_minimization(tpr_file, emin_prefix, nthreads, pin_offset=0, mdrun_options=None, cwd="."):
     # 에너지 최소화 실행
-    run_command(["gmx", "mdrun", "-deffnm", emin_prefix])
-    # 최종 구조는 emin_<iteration>.gro 파일로 출력됨
-    return f"{emin_prefix}.tpr", f"{emin_prefix}.gro"
-
-def run_segment(segment_number, start_coord):
-    seg_prefix = f"segment_{segment_number}"
-    run_command(["gmx", "grompp", "-f", "short.mdp", "-c", start_coord, "-p", "topol.top", "-n", "index.ndx", "-o", f"{seg_prefix}.tpr"])
-    run_command(["gmx", "mdrun", "-deffnm", seg_prefix])
-    # 반환: tpr, 최종 구조 gro, trajectory xtc
-    return f"{seg_prefix}.tpr", f"{seg_prefix}.gro", f"{seg_prefix}.xtc"
-
-def check_distance(sim_file, tpr_file, peptide_res_list, protein_res_list):
+    run_command(mdrun_command(emin_prefix, nthreads, pin_offset, mdrun_options, em=True) + ["-s", tpr_file],
+                cwd=cwd, log_file=os.path.join(cwd, f"{emin_prefix}.stdout"))
+    # 최종 구조는 <emin_prefix>.gro (emin_<iteration>.gro) 파일로 출력됨
+    return tpr_file, f"{emin_prefix}.gro"
+
+def prepare_segment(segment_number, branch, start_coord, start_checkpoint=None, cwd=".", mdp_file="short.mdp"):
+    # 이전 segment에서 이어갈 때는 start_coord에 이전 tpr, start_checkpoint에 마지막 cpt를 넘김
+    # (좌표와 box를 cpt에서 읽으므로 .gro를 따로 쓰지 않아도 됨)
+    seg_prefix = f"segment_{segment_number}_{branch}"
+    cmd = ["gmx", "grompp", "-f", mdp_file, "-c", start_coord, "-p", "topol.top", "-n", "index.ndx", "-o", f"{seg_prefix}.tpr"]
+    if start_checkpoint is not None:
+        cmd += ["-t", start_checkpoint]
+    run_command(cmd, cwd=cwd)
+    return seg_prefix
+
+def run_segment(seg_prefix, nthreads, pin_offset=0, mdrun_options=None, cwd="."):
+    # 최종 구조(.gro)는 쓰지 않음. 거리는 xtc로, 다음 segment는 cpt로 이어감
+    run_command(mdrun_command(seg_prefix, nthreads, pin_offset, mdrun_options) + ["-noconfout"],
+                cwd=cwd, log_file=os.path.join(cwd, f"{seg_prefix}.stdout"))
+    # 반환: tpr, 마지막 checkpoint cpt, trajectory xtc
+    return f"{seg_prefix}.tpr", f"{seg_prefix}.cpt", f"{seg_prefix}.xtc"
+
+def read_last_xvg_row(xvg_file, tail_bytes=8192):
+    # 파일 끝의 tail_bytes만 읽어서 마지막 데이터 줄을 찾고, 없으면 파일 전체를 읽음
+    with open(xvg_file, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        start = max(0, end - tail_bytes)
+        while True:
+            f.seek(start)
+            lines = f.read().decode().splitlines()
+            # 중간부터 읽었다면 첫 줄은 잘린 줄일 수 있으므로 제외
+            if start > 0:
+                lines = lines[1:]
+            for line in reversed(lines):
+                if not line.startswith(("#", "@")):
+                    parts = line.split()
+                    if len(parts) >= 2:
+                        return [float(x) for x in parts]
+            if start == 0:
+                return None
+            start = 0
+
+def check_distance(sim_file, tpr_file, peptide_res_list, protein_res_list, begin_time=None, cwd="."):
     """
     –select 옵션에서 inline으로 여러 residue를 union하여 계산하도록 합니다.
-    예를 들어, peptide_res_list = ['45','46','47']인 경우,
+    예를 들어, peptide_res_list = [45, 46, 47]인 경우,
       peptide_sel = "r 45 | r 46 | r 47"
     최종 선택식:
       "com of ( r 45 | r 46 | r 47 ) plus com of ( r 123 | r 124 | r 125 )"
+    begin_time (ps)을 주면 그 이전 frame은 읽지 않습니다 (trajectory의 마지막 frame만 필요할 때).
+    파일 이름은 모두 cwd 기준입니다.
     """
     peptide_sel = " | ".join(f"r {res}" for res in peptide_res_list)
     protein_sel = " | ".join(f"r {res}" for res in protein_res_list)
     select_string = f"com of ( {peptide_sel} ) plus com of ( {protein_sel} )"
     
     distance_output = "distance.xvg"
-    run_command([
+    cmd = [
         "gmx", "distance",
         "-s", tpr_file,
         "-f", sim_file,
         "-n", "index.ndx",
         "-select", select_string,
         "-oall", distance_output
-    ])
+    ]
+    if begin_time is not None:
+        cmd += ["-b", str(begin_time)]
+    run_command(cmd, cwd=cwd)
     
-    final_distance = None
-    with open(distance_output, "r") as f:
-        lines = f.readlines()
-        for line in reversed(lines):
-            if not line.startswith(("#", "@")):
-                parts = line.strip().split()
-                if len(parts) >= 2:
-                    final_distance = float(parts[1])
-                    break
-    if final_distance is None:
+    last_row = read_last_xvg_row(os.path.join(cwd, distance_output))
+    if last_row is None and begin_time is not None:
+        # -b 이후 frame이 없으면 전체 trajectory에서 다시 계산
+        return check_distance(sim_file, tpr_file, peptide_res_list, protein_res_list, cwd=cwd)
+    if last_row is None:
         raise RuntimeError("Failed to extract distance from distance.xvg")
+    final_distance = last_row[1]
     
     print(f"Final distance between peptide and protein groups: {final_distance} nm")
     return final_distance
 
+def segment_mdp(output_dir, args, replica, segment, branch):
+    # --seed_base가 없으면 모든 branch가 short.mdp (gen_seed = -1, 임의 seed)를 공유
+    # 있으면 (replica, segment, branch)마다 다른 seed로 mdp를 써서 재현 가능하게 함
+    # 파일 이름에 seed를 넣어서 다른 --seed_base로 다시 실행할 때 예전 seed 파일을 재사용하지 않도록 함
+    if args.seed_base is None:
+        return "short.mdp"
+    seed = args.seed_base + (replica * args.max_segments + segment - 1) * args.branches + branch - 1
+    mdp_file = f"short_{segment}_{branch}_seed{seed}.mdp"
+    create_short_mdp(os.path.join(output_dir, mdp_file), gen_seed=seed)
+    return mdp_file
+
+def run_replica(args, replica, output_dir, nthreads, pin_base, mdrun_options):
+    # 한 replica의 시스템 준비 -> 에너지 최소화 -> MD segment 전체 과정. 모든 파일은 output_dir에 씀
+    # nthreads개의 core (pin_base부터)를 이 replica가 사용
+    os.makedirs(output_dir, exist_ok=True)
+
+    # main에서 한 번만 만든 mdp 파일을 replica 디렉토리로 link
+    if os.path.abspath(output_dir) != os.path.abspath(args.output_dir):
+        for name in ("short.mdp", "emin.mdp"):
+            link_or_copy(os.path.join(args.output_dir, name), os.path.join(output_dir, name))
+    
+    # 시스템 준비: Topology 생성, 박스, 솔베이션, 기본 index 파일 생성
+    prepare_system(args.pdb, args.peptide_res, args.protein_res, cwd=output_dir,
+                   cache_root=os.path.join(args.output_dir, SYSTEM_CACHE_DIR))
+    
+    # 초기 구조: solvated.gro 파일을 사용
+    current_coord = "solvated.gro"
+    
+    # MD branch를 동시에 실행할 thread pool은 segment마다 새로 만들지 않고 replica 전체에서 재사용
+    with ThreadPoolExecutor(max_workers=args.branches) as executor:
+        # Energy Minimization 단계: peptide와 protein의 COM 사이 거리가 cutoff (0.5 nm) 이하가 될 때까지 반복
+        # steep 최소화는 결정적이므로 같은 tpr에서 여러 sample을 돌려도 결과가 같음. iteration당 한 번만 실행
+        emin_iter = 0
+        current_distance = None
+        while emin_iter < args.max_emin_iter:
+            emin_iter += 1
+            print(f"\n--- Energy Minimization Iteration {emin_iter} ---")
+
+            emin_tpr = prepare_energy_minimization(emin_iter, current_coord, cwd=output_dir,
+                                                  cache_dir=os.path.join(args.output_dir, TPR_CACHE_DIR))
+            try:
+                tpr_file, coord_file = run_energy_minimization(emin_tpr, f"emin_{emin_iter}", nthreads, pin_base, mdrun_options, output_dir)
+                emin_distance = check_distance(coord_file, tpr_file, args.peptide_res, args.protein_res, cwd=output_dir)
+            except Exception as e:
+                print(f"에너지 최소화 실패: {e}. 시뮬레이션을 종료합니다.")
+                break
+
+            print(f"에너지 최소화 후 거리: {emin_distance:.3f} nm")
+            # 다음 iteration (또는 MD segment)의 시작 구조
+            current_coord = coord_file
+
+            if emin_distance <= args.distance_threshold:
+                print("Cutoff 도달! Energy Minimization 단계 완료.")
+                break
+            else:
+                print("Cutoff에 도달하지 않았으므로, 에너지 최소화를 반복합니다.")
+        else:
+            print("최대 Energy Minimization 반복 횟수에 도달하였습니다.")
+
+    
+        # Energy Minimization 후 cutoff 상태에서 MD 세그먼트 실행 (최종 pose 형성 탐색)
+        previous_distance = None
+        current_checkpoint = None
+        branches = list(range(1, args.branches + 1))
+        branch_threads = max(1, nthreads // len(branches))
+        for segment in range(1, args.max_segments + 1):
+            print(f"\n--- Running MD Segment {segment} ({len(branches)} branches) ---")
+
+            # 같은 시작 구조에서 초기 속도만 다른 branch들을 동시에 실행하고 거리가 가장 짧은 branch를 선택
+            mdp_files = [segment_mdp(output_dir, args, replica, segment, branch) for branch in branches]
+            seg_prefixes = [prepare_segment(segment, branch, current_coord, current_checkpoint, output_dir, mdp_file)
+                            for branch, mdp_file in zip(branches, mdp_files)]
+            futures = [executor.submit(run_segment, seg_prefix, branch_threads, pin_base + i * branch_threads, mdrun_options, output_dir)
+                       for i, seg_prefix in enumerate(seg_prefixes)]
+
+            # mdrun 또는 거리 계산이 실패한 branch는 건너뛰고 나머지 branch로 계속 진행
+            branch_results = []
+            for seg_prefix, mdp_file, future in zip(seg_prefixes, mdp_files, futures):
+                try:
+                    md_tpr, md_cpt, md_xtc = future.result()
+                    dist = check_distance(md_xtc, md_tpr, args.peptide_res, args.protein_res,
+                                          begin_time=last_frame_time(os.path.join(output_dir, mdp_file)), cwd=output_dir)
+                    branch_results.append((dist, md_tpr, md_cpt))
+                except Exception as e:
+                    print(f"Branch {seg_prefix} 실패: {e}")
+
+            if not branch_results:
+                print("모든 MD branch가 실패했습니다. 시뮬레이션을 종료합니다.")
+                break
+            # 다음 세그먼트 시작 상태로 업데이트
+            current_distance, current_coord, current_checkpoint = min(branch_results, key=lambda x: x[0])
+            print(f"가장 짧은 branch 거리: {current_distance:.3f} nm")
+        
+            if current_distance < args.distance_threshold:
+                print("최종 pose가 cutoff 내에 도달하였습니다. MD 시뮬레이션 완료.")
+                break
+        
+            if previous_distance is not None and current_distance >= previous_distance:
+                print("거리 감소가 없으므로 MD 시뮬레이션을 종료합니다.")
+                break
+            previous_distance = current_distance
+
+    return current_distance
+
 def main():
     parser = argparse.ArgumentParser(
         description="Gromacs와 AMBER14SB force field를 이용한 peptide-protein SuMD 시뮬레이션 자동화\n"
                     "여러 residue 번호를 공백으로 구분해서 입력할 수 있습니다."
     )
     parser.add_argument("--pdb", required=True, help="Complex PDB file")
-    parser.add_argument("--peptide_res", nargs="+", required=True,
+    parser.add_argument("--peptide_res", nargs="+", type=int, required=True,
                         help="Peptide의 결합하는 residue 번호들 (여러 개 가능)")
-    parser.add_argument("--protein_res", nargs="+", required=True,
+    parser.add_argument("--protein_res", nargs="+", type=int, required=True,
                         help="Protein의 결합하는 residue 번호들 (여러 개 가능)")
     parser.add_argument("--max_emin_iter", type=int, default=5,
                         help="최대 Energy Minimization 반복 횟수")
@@ -149,72 +472,76 @@ def main():
                         help="최대 MD 세그먼트 수")
     parser.add_argument("--distance_threshold", type=float, default=0.5,
                         help="Cutoff 거리 (nm); 기본 0.5 nm (5 Å)")
+    parser.add_argument("--nthreads", type=int, default=os.cpu_count(),
+                        help="gmx mdrun에 사용할 thread 수 (기본: 전체 core 수)")
+    parser.add_argument("--ntmpi", type=int, default=1,
+                        help="gmx mdrun thread-MPI rank 수")
+    parser.add_argument("--ntomp", type=int, default=None,
+                        help="rank당 OpenMP thread 수 (기본: nthreads / ntmpi)")
+    parser.add_argument("--nb", choices=["auto", "cpu", "gpu"], default=None,
+                        help="Non-bonded 계산 위치 (기본: GPU가 있으면 gpu, 없으면 cpu)")
+    parser.add_argument("--pme", choices=["auto", "cpu", "gpu"], default="auto",
+                        help="PME 계산 위치 (mdp가 PME를 사용할 때만 의미 있음, 에너지 최소화에서는 gpu 무시)")
+    parser.add_argument("--bonded", choices=["auto", "cpu", "gpu"], default="auto",
+                        help="Bonded 계산 위치")
+    parser.add_argument("--update", choices=["auto", "cpu", "gpu"], default="auto",
+                        help="MD segment의 update/constraint 계산 위치 (기본: GROMACS가 지원 여부에 따라 선택)")
+    parser.add_argument("--gpu_id", default=None,
+                        help="사용할 GPU ID 문자열 (예: 01)")
+    parser.add_argument("--branches", type=int, default=2,
+                        help="MD 세그먼트마다 초기 속도를 달리해서 동시에 실행할 branch 수")
+    parser.add_argument("--output_dir", default=".",
+                        help="모든 GROMACS 입출력 파일을 쓸 작업 디렉토리")
+    parser.add_argument("--replicas", type=int, default=1,
+                        help="동시에 실행할 독립 SuMD replica 수 (2 이상이면 output_dir/rep<i>에 저장)")
+    parser.add_argument("--seed_base", type=int, default=None,
+                        help="초기 속도 생성 seed의 시작값 (기본: 매번 임의 seed)")
     args = parser.parse_args()
-    
-    # MD 및 에너지 최소화용 mdp 파일 생성
-    create_short_mdp("short.mdp")
-    create_emin_mdp("emin.mdp")
-    
-    # 시스템 준비: Topology 생성, 박스, 솔베이션, 기본 index 파일 생성
-    prepare_system(args.pdb)
-    
-    # 초기 구조: solvated.gro 파일을 사용
-    current_coord = "solvated.gro"
-    
-    # Energy Minimization 단계: peptide와 protein의 COM 사이 거리가 cutoff (0.5 nm) 이하가 될 때까지 반복
-    emin_iter = 0
-    current_distance = None
-    while emin_iter < args.max_emin_iter:
-        emin_iter += 1
-        print(f"\n--- Energy Minimization Iteration {emin_iter} (4 samples) ---")
-
-        sample_results = []
-        for sample_id in range(1, 5):  # 4개의 sample 실행
-            tag = f"{emin_iter}_{sample_id}"
-            tpr_file, coord_file = run_energy_minimization(tag, current_coord)
-            try:
-                dist = check_distance(coord_file, tpr_file, args.peptide_res, args.protein_res)
-                sample_results.append((dist, coord_file, tpr_file))
-            except Exception as e:
-                print(f"Sample {tag} 실패: {e}")
 
-        if not sample_results:
-            print("모든 에너지 최소화 sample이 실패했습니다. 시뮬레이션을 종료합니다.")
-            break
+    # --nb를 지정하지 않으면 GPU 유무에 따라 결정
+    # (PME/bonded는 mdp 설정과 integrator에 따라 GPU에서 안 될 수 있으므로 auto로 두고 GROMACS가 선택)
+    n_gpus = detect_gpus()
+    offload = "gpu" if n_gpus else "cpu"
+    print(f"Detected {n_gpus} GPU(s): nb 기본값 = {offload}")
 
-        # 가장 짧은 거리의 sample 선택
-        sample_results.sort(key=lambda x: x[0])  # distance 기준 정렬
-        best_distance, best_coord, best_tpr = sample_results[0]
+    mdrun_options = {
+        "ntmpi": args.ntmpi,
+        "ntomp": args.ntomp,
+        "nb": args.nb or offload,
+        "pme": args.pme,
+        "bonded": args.bonded,
+        "update": args.update,
+        "gpu_id": args.gpu_id,
+    }
 
-        print(f"가장 짧은 거리: {best_distance:.3f} nm (선택된 sample)")
+    # MD 및 에너지 최소화용 mdp 파일 생성 (replica들은 이 파일을 link해서 사용)
+    os.makedirs(args.output_dir, exist_ok=True)
+    create_short_mdp(os.path.join(args.output_dir, "short.mdp"))
+    create_emin_mdp(os.path.join(args.output_dir, "emin.mdp"))
 
-        if best_distance <= args.distance_threshold:
-            print("Cutoff 도달! Energy Minimization 단계 완료.")
-            current_coord = best_coord
-            break
-        else:
-            print("Cutoff에 도달하지 않았으므로, 에너지 최소화를 반복합니다.")
-            current_coord = best_coord  # 다음 iteration의 시작 구조
-    else:
-        print("최대 Energy Minimization 반복 횟수에 도달하였습니다.")
+    if args.replicas == 1:
+        run_replica(args, 0, args.output_dir, args.nthreads, 0, mdrun_options)
+        return
 
-    
-    # Energy Minimization 후 cutoff 상태에서 MD 세그먼트 실행 (최종 pose 형성 탐색)
-    previous_distance = None
-    for segment in range(1, args.max_segments + 1):
-        print(f"\n--- Running MD Segment {segment} ---")
-        md_tpr, md_coord, md_xtc = run_segment(segment, current_coord)
-        current_distance = check_distance(md_xtc, md_tpr, args.peptide_res, args.protein_res)
-        current_coord = md_coord  # 다음 세그먼트 시작 좌표로 업데이트
-        
-        if current_distance < args.distance_threshold:
-            print("최종 pose가 cutoff 내에 도달하였습니다. MD 시뮬레이션 완료.")
-            break
-        
-        if previous_distance is not None and current_distance >= previous_distance:
-            print("거리 감소가 없으므로 MD 시뮬레이션을 종료합니다.")
-            break
-        previous_distance = current_distance
+    # replica마다 core를 나눠서 별도 process로 실행하고 마지막 거리를 모아서 출력
+    # Linux에서는 forkserver로 worker를 만들어 spawn처럼 매번 interpreter를 새로 띄우지 않음
+    replica_threads = max(1, args.nthreads // args.replicas)
+    mp_context = mp.get_context("forkserver" if sys.platform.startswith("linux") else "spawn")
+    with ProcessPoolExecutor(max_workers=args.replicas, mp_context=mp_context) as executor:
+        futures = [executor.submit(run_replica, args, i, os.path.join(args.output_dir, f"rep{i}"),
+                                   replica_threads, i * replica_threads, mdrun_options)
+                   for i in range(args.replicas)]
+        final_distances = []
+        for i, future in enumerate(futures):
+            try:
+                final_distances.append(future.result())
+            except Exception as e:
+                print(f"Replica {i} 실패: {e}")
+                final_distances.append(None)
+
+    print("\n--- Replica summary ---")
+    for i, dist in enumerate(final_distances):
+        print(f"rep{i}: 실패" if dist is None else f"rep{i}: {dist:.3f} nm")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
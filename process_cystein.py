@@ -1,53 +1,68 @@
-from Bio.PDB import PDBParser, PDBIO
 import numpy as np
-from Bio.PDB.Atom import Atom
 
 input="/root/genion_test/20250318/test0317.pdb"
 output="/root/genion_test/20250318/test0318_cys.pdb"
 
-# 1. PDB 파일 파싱 (파일명은 "input.pdb"로 가정)
-parser = PDBParser(QUIET=True)
-structure = parser.get_structure("my_structure", input)
-
-# 2. 모델, 체인, 잔기를 순회하면서 CYS 잔기 찾기
-for model in structure:
-    for chain in model:
-        for residue in chain:
-            if residue.get_resname() == "CYS":
-                # 이미 HG가 존재하면 건너뜁니다.
-                if "HG" not in residue:
-                    # SG와 CA 원자가 있는지 확인
-                    if "SG" in residue and "CA" in residue:
-                        sg_atom = residue["SG"]
-                        ca_atom = residue["CA"]
-                        
-                        # 3. SG와 CA 사이의 벡터 계산 및 단위 벡터 산출
-                        vector = sg_atom.coord - ca_atom.coord
-                        norm = np.linalg.norm(vector)
-                        if norm == 0:
-                            continue  # 0 나누기 방지
-                        unit_vector = vector / norm
-                        
-                        # S-H 결합 길이 (Å): 일반적으로 약 1.33 Å
-                        bond_length = 1.33
-                        hg_coord = sg_atom.coord + unit_vector * bond_length
-                        
-                        # 4. 새로운 HG 원자 생성 (serial_number는 추후 조정 가능)
-                        hg_atom = Atom(name="HG",
-                                       coord=hg_coord,
-                                       bfactor=sg_atom.get_bfactor(),
-                                       occupancy=sg_atom.get_occupancy(),
-                                       altloc=sg_atom.get_altloc(),
-                                       fullname=" HG ",
-                                       serial_number=0,
-                                       element="H")
-                        
-                        # HG 원자를 잔기에 추가합니다.
-                        residue.add(hg_atom)
-                    else:
-                        print(f"Residue {residue.get_id()}는 SG 또는 CA 원자가 없어 HG를 추가하지 않습니다.")
-                        
-# 5. 변경된 구조를 새로운 PDB 파일("output_with_HG.pdb")로 저장
-io = PDBIO()
-io.set_structure(structure)
-io.save(output)
+def atom_coord(line):
+    # PDB 고정 컬럼: x = 31-38, y = 39-46, z = 47-54
+    return [float(line[30:38]), float(line[38:46]), float(line[46:54])]
+
+# 1. PDB 파일을 줄 단위로 읽으면서 CYS 잔기의 원자 위치(줄 번호) 수집
+#    PDB 고정 컬럼: atom name = 13-16, resName = 18-20, chain = 22, resSeq + iCode = 23-27
+with open(input, 'r') as f:
+    lines = f.readlines()
+
+cys_residues = {}  # (model, chain, resSeq + iCode) -> {atom name: 줄 번호}
+model = 0
+max_serial = 0
+for i, line in enumerate(lines):
+    record = line[:6]
+    if record == "MODEL ":
+        model += 1
+    elif record in ("ATOM  ", "HETATM"):
+        max_serial = max(max_serial, int(line[6:11]))
+        if line[17:20] == "CYS":
+            cys_residues.setdefault((model, line[21], line[22:27]), {})[line[12:16].strip()] = i
+
+# 2. HG를 추가할 CYS 잔기 모으기
+targets = []
+for residue_id, atoms in cys_residues.items():
+    # 이미 HG가 존재하면 건너뜁니다.
+    if "HG" in atoms:
+        continue
+    # SG와 CA 원자가 있는지 확인
+    if "SG" in atoms and "CA" in atoms:
+        targets.append(atoms)
+    else:
+        print(f"Residue {residue_id}는 SG 또는 CA 원자가 없어 HG를 추가하지 않습니다.")
+
+hg_lines = {}  # SG 줄 번호 -> 바로 뒤에 넣을 HG 줄
+if targets:
+    # 3. 모든 CYS의 SG-CA 벡터와 단위 벡터, HG 좌표를 한 번에 계산
+    sg_coords = np.array([atom_coord(lines[atoms["SG"]]) for atoms in targets])
+    ca_coords = np.array([atom_coord(lines[atoms["CA"]]) for atoms in targets])
+    vectors = sg_coords - ca_coords
+    # 길이 제곱으로 먼저 걸러내고, 유효한 벡터에 대해서만 sqrt 계산
+    sq_norms = np.einsum("ij,ij->i", vectors, vectors)
+    valid = sq_norms > 1e-6  # 0 나누기 방지 (|SG-CA| < 0.001 Å)
+
+    # S-H 결합 길이 (Å): 일반적으로 약 1.33 Å
+    bond_length = 1.33
+    hg_coords = sg_coords[valid] + vectors[valid] / np.sqrt(sq_norms[valid])[:, None] * bond_length
+    targets = [atoms for atoms, is_valid in zip(targets, valid) if is_valid]
+
+    # 4. 새로운 HG 원자 줄 생성 (serial은 기존 최대값 다음부터, altloc/잔기/occupancy/B-factor는 SG 줄을 따름)
+    next_serial = max_serial + 1
+    for atoms, (x, y, z) in zip(targets, hg_coords):
+        sg_line = lines[atoms["SG"]].rstrip("\n")
+        hg_lines[atoms["SG"]] = (f"{sg_line[:6]}{next_serial:5d}  HG {sg_line[16:27]}   "
+                                 f"{x:8.3f}{y:8.3f}{z:8.3f}{sg_line[54:66].ljust(12)}           H\n")
+        next_serial += 1
+
+# 5. 각 SG 줄 바로 뒤에 HG 줄을 넣어서 새로운 PDB 파일로 저장 (나머지 줄은 그대로 복사)
+# 1 MiB 버퍼로 열어서 ATOM 줄마다 작은 write가 일어나지 않도록 함
+with open(output, 'w', buffering=1 << 20) as f:
+    for i, line in enumerate(lines):
+        f.write(line)
+        if i in hg_lines:
+            f.write(hg_lines[i])